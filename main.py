@@ -1,13 +1,21 @@
-from typing import Dict, List, NamedTuple
+from typing import Dict, List, NamedTuple, Tuple
+from collections import Counter
+from operator import attrgetter
 
 import os
+import sys
 import errno
 from openpyxl import load_workbook
+from openpyxl.workbook.workbook import Workbook
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.realpath(__file__))
 
 # Make sure the files starts with these strings in the same directory as this script.
 TUTORIAL_LIST_FILENAME = "tutorials_merged_20230928"  # should be .xlsx
 ATTENDANCE_NAMES_FILE = "bot_input"  # any text file format
 OVERWRITE_MODE = True  # if false, will first reset the sheet's score to 0 before updating attendance
+# Cells are read as stored, a formula in the sid, username, or score columns switches to reading cached values automatically
+DATA_ONLY = False  # set to true to always read the cached values of formulas, only the cells the script writes lose their formulas
 
 
 # These needs to be updated every week
@@ -41,6 +49,7 @@ def main():
         input_path=bot_attendance_path,
         tutorial_number=TUTORIAL_NUMBER,
         overwrite_mode=OVERWRITE_MODE,
+        data_only=DATA_ONLY,
     )
 
     attendance.run()
@@ -56,19 +65,44 @@ def find_file_path(file_str: str) -> str:
     Returns:
         str: absolute path to the file
     """
-    current_directory = os.path.dirname(os.path.realpath(__file__))
-
-    for filename in os.listdir(current_directory):
-        if filename.startswith(file_str):
-            return os.path.join(current_directory, filename)
+    with os.scandir(SCRIPT_DIRECTORY) as entries:
+        for entry in entries:
+            if entry.name.startswith(file_str):
+                return entry.path
 
     raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), file_str)
 
 
+def sid_sort_key(sid: int | str) -> Tuple[int, int, str]:
+    """
+    Sort key that orders numeric sids (stored as numbers or decimal text) numerically,
+    followed by any other sids as text. The sid itself is left untouched.
+
+    Args:
+        sid (int | str): the student's sid
+
+    Returns:
+        Tuple[int, int, str]: key comparable across all sid types
+    """
+    if isinstance(sid, int):
+        return (0, sid, str(sid))
+    if isinstance(sid, str) and sid.isdecimal():
+        return (0, int(sid), sid)
+
+    return (1, 0, str(sid))
+
+
+class FormulaFoundError(Exception):
+    """
+    Raised when the tutorial sheet holds a formula where a plain value was expected
+    """
+
+
 class StudentAttendance(NamedTuple):
     username: str
-    sid: str
+    sid: int | str
     score: int | float
+    sort_key: Tuple[int, int, str]  # precomputed sid_sort_key(sid), so sorting can use attrgetter
 
 
 class TakeAttendance:
@@ -78,11 +112,14 @@ class TakeAttendance:
         input_path: str,
         tutorial_number: int,
         overwrite_mode: bool = True,
+        data_only: bool = False,
     ) -> None:
         self.output_path: str = output_path
         self.input_path: str = input_path
         self.tutorial_number: str = f"Tutorial {tutorial_number}"
         self.overwrite_mode: bool = overwrite_mode
+        self.data_only: bool = data_only
+        self._cols: Tuple[int, int, int] | None = None
 
     def _load_student_attendance(self) -> List[str]:
         """
@@ -92,80 +129,152 @@ class TakeAttendance:
             List[str]: a list of strings, each string is a student's username
         """
         try:
-            with open(self.input_path, "r") as file:
-                usernames = [
-                    next(
-                        filter(lambda x: x.startswith("#"), line.split(",", 1))
-                    ).strip()
-                    for line in file
-                ]
+            usernames = []
+
+            # Large buffer so the whole bot output is pulled in with one or two reads
+            with open(self.input_path, "r", buffering=1 << 17) as file:
+                for line in file:
+                    # The "#" username is either the head or the tail of the line
+                    head = line.lstrip()
+
+                    if head.startswith("#"):
+                        usernames.append(head.split(",", 1)[0].rstrip())
+                        continue
+
+                    idx = line.find(",#")
+
+                    if idx >= 0:
+                        usernames.append(line[idx + 1 :].strip())
+                    elif head:
+                        raise Exception(f"No username found in line: {line.strip()}")
+
             return usernames
         except Exception as e:
             print("ERROR >>> Unable to parse student attendance file!")
             raise Exception(e)
 
-    def _load_tutorial_list(self) -> Dict[str, StudentAttendance]:
+    def _resolve_columns(self, header: Tuple) -> Tuple[int, int, int]:
         """
-        Load the tutorial student list from the file specified by self.output_path
+        Determine which columns are sid, username, and score from the header row.
+        The result is cached, since the header does not change between passes.
+
+        Args:
+            header (Tuple): the values of the tutorial worksheet's first row
 
         Returns:
-            Dict[str, StudentAttendance]: a dictionary, the key is the username, the value is a StudentAttendance NamedTuple
+            Tuple[int, int, int]: 1-based column indices of sid, username, and score
+        """
+        if self._cols is not None:
+            return self._cols
+
+        for i, col_str in enumerate(header[:3], start=1):
+            if col_str == "OrgDefinedId":
+                sid_col = i
+            elif col_str == "Username":
+                username_col = i
+            elif col_str.startswith("Tutorial"):
+                score_col = i
+            else:
+                raise Exception("Undefined column name")
+
+        self._cols = (sid_col, username_col, score_col)
+
+        return self._cols
+
+    def _open_tutorial_workbook(self, data_only: bool = False) -> Workbook:
+        """
+        Open the tutorial workbook from the file specified by self.output_path
+
+        Args:
+            data_only (bool): open a read-only copy with cached formula values instead of the writable workbook
+
+        Returns:
+            Workbook: the opened workbook
         """
         try:
-            workbook = load_workbook(
-                filename=self.output_path, data_only=True, read_only=True
+            if data_only:
+                return load_workbook(
+                    filename=self.output_path, read_only=True, data_only=True
+                )
+
+            return load_workbook(
+                filename=self.output_path, read_only=False, keep_vba=False
             )
+        except Exception as e:
+            print("ERROR >>> Unable to parse tutorial file!")
+            raise Exception(e)
+
+    def _load_tutorial_list(self, workbook: Workbook) -> Dict[str, StudentAttendance]:
+        """
+        Load the tutorial student list from the workbook opened from self.output_path
+
+        Args:
+            workbook (Workbook): the tutorial workbook, either shared with _write_tutorial_list
+                or a separate read-only data_only copy when self.data_only is set
+
+        Returns:
+            Dict[str, StudentAttendance]: a dictionary, the key is the username, the value is a StudentAttendance NamedTuple
+
+        Raises:
+            FormulaFoundError: a formula was read while self.data_only is not set
+        """
+        try:
             worksheet = workbook[self.tutorial_number]
 
-            # Determine which columns are sid, username, and score
-            for i in range(1, 4):
-                col_str = worksheet.cell(1, i).value
+            rows = worksheet.values
+            header = next(rows)
 
-                if col_str == "OrgDefinedId":
-                    sid_col = i
-                elif col_str == "Username":
-                    username_col = i
-                elif col_str.startswith("Tutorial"):
-                    score_col = i
-                else:
-                    raise Exception("Undefined column name")
+            sid_col, username_col, score_col = self._resolve_columns(header)
 
             tut_list_dict = {}
-            num_rows = 0
 
-            # Count number of non-empty rows
-            for row in worksheet:
-                if not all(col.value is None for col in row):
-                    num_rows += 1
+            # Create dict in a single streaming pass, no need to count rows beforehand
+            for row_values in rows:
+                key = row_values[username_col - 1]
+                sid = row_values[sid_col - 1]
+                curr_score = row_values[score_col - 1]
 
-            # Create dict
-            for row in range(2, num_rows + 1):
-                key = worksheet.cell(row, username_col).value
+                # Skip rows that are blank in all three columns
+                if key is None and sid is None and curr_score is None:
+                    continue
 
                 if key in tut_list_dict:
                     raise Exception("Duplicate username found")
 
-                curr_score = worksheet.cell(row, score_col).value
+                if not self.data_only:
+                    for col_name, col_value in (
+                        ("OrgDefinedId", sid),
+                        ("Username", key),
+                        (self.tutorial_number, curr_score),
+                    ):
+                        if isinstance(col_value, str) and col_value.startswith("="):
+                            raise FormulaFoundError(
+                                f"Formula found in {col_name} column: {col_value}"
+                            )
+
+                sort_key = sid_sort_key(sid)
 
                 if self.overwrite_mode and curr_score is not None and curr_score > 0:
                     value = StudentAttendance(
                         username=key,
-                        sid=worksheet.cell(row, sid_col).value,
+                        sid=sid,
+                        sort_key=sort_key,
                         score=curr_score if curr_score <= MAX_SCORE else MAX_SCORE,
                     )
                 else:
                     value = StudentAttendance(
                         username=key,
-                        sid=worksheet.cell(row, sid_col).value,
+                        sid=sid,
+                        sort_key=sort_key,
                         score=0,
                     )
 
                 tut_list_dict[key] = value
 
-            workbook.close()
-
             return tut_list_dict
 
+        except FormulaFoundError:
+            raise
         except Exception as e:
             print("ERROR >>> Unable to parse tutorial file!")
             raise Exception(e)
@@ -184,78 +293,98 @@ class TakeAttendance:
             List[StudentAttendance]: list of students from the tutorial list, updated with the students in attendance
         """
 
-        username_set = set(usernames)
+        attendance_marks = Counter(usernames)
 
-        attendance_marks = {
-            username: usernames.count(username) for username in username_set
-        }
+        # Partition the bot's usernames into roster hits and misses with set operations
+        found = sorted(attendance_marks.keys() & tutorial_dict.keys())
+        missing = sorted(attendance_marks.keys() - tutorial_dict.keys())
+
+        # Collect the report lines and write them to stdout in one go
+        report = []
+
+        # Bind loop invariants to locals
+        add_line = report.append
+        max_score = MAX_SCORE
+
+        # Write the buffered lines even if an invalid attendance stops the update
+        try:
+            # Warnings go first so they are reported even if an invalid attendance is found
+            for username in missing:
+                add_line(f"WARNING >>> Username: {username} not found in tutorial list!")
 
-        for username in username_set:
-            if username in tutorial_dict:
-                old_score = tutorial_dict[username].score
+            for username in found:
+                student = tutorial_dict[username]
+                mark = attendance_marks[username]
+                old_score = student.score
 
-                if attendance_marks[username] > 2:
+                if mark > 2:
                     raise Exception(
-                        f"Invalid student attendance with username: {username} (count: {attendance_marks[username]})"
+                        f"Invalid student attendance with username: {username} (count: {mark})"
                     )
 
                 # only use attendance score if the student does not have the max score (i.e. been checked off)
-                new_score = (
-                    attendance_marks[username]
-                    if old_score < MAX_SCORE
-                    else MAX_SCORE
-                )
+                new_score = mark if old_score < max_score else max_score
 
-                tutorial_dict[username] = StudentAttendance(
-                    username=username, sid=tutorial_dict[username].sid, score=new_score
-                )
-                print(
+                tutorial_dict[username] = student._replace(score=new_score)
+                add_line(
                     f"Updated {username:<25} {'-':<2} Old: {old_score} | New: {new_score}"
                 )
-            else:
-                print(f"WARNING >>> Username: {username} not found in tutorial list!")
+        finally:
+            if report:
+                sys.stdout.write("\n".join(report) + "\n")
 
         return list(tutorial_dict.values())
 
-    def _write_tutorial_list(self, students: List[StudentAttendance]) -> int:
+    def _write_tutorial_list(
+        self, workbook: Workbook, students: List[StudentAttendance]
+    ) -> int:
         """
-        Write the tutorial list to the file specified by self.output_path
+        Write the tutorial list into the workbook, then save it to self.output_path
 
         Args:
+            workbook (Workbook): the writable tutorial workbook, which keeps its formulas
             students (List): list of StudentAttendance NamedTuples
 
         Returns:
             int: number of students written to file
         """
-        students.sort(key=lambda x: x.sid)
-
         try:
-            workbook = load_workbook(filename=self.output_path)
+            students.sort(key=attrgetter("sort_key"))
+
             worksheet = workbook[self.tutorial_number]
 
-            # Determine which columns are sid, username, and score
-            for i in range(1, 4):
-                col_str = worksheet.cell(1, i).value
+            rows = worksheet.iter_rows(max_col=3)
+            header = tuple(cell.value for cell in next(rows))
 
-                if col_str == "OrgDefinedId":
-                    sid_col = i
-                elif col_str == "Username":
-                    username_col = i
-                elif col_str.startswith("Tutorial"):
-                    score_col = i
-                else:
-                    raise Exception("Undefined column name")
-
-            # Write to file
-            for row, student in enumerate(students, start=2):
-                worksheet.cell(row, sid_col).value = student.sid
-                worksheet.cell(row, username_col).value = student.username
-                worksheet.cell(row, score_col).value = (
-                    student.score if student.score > 0 else None
+            # 0-based positions of sid, username, and score within each row
+            positions = tuple(col - 1 for col in self._resolve_columns(header))
+
+            # Write to file, walking the existing rows and only touching cells whose value changed.
+            # students goes first in zip so that no row is consumed once they run out.
+            row = 1
+            for row, (student, cells) in enumerate(zip(students, rows), start=2):
+                values = (
+                    student.sid,
+                    student.username,
+                    student.score if student.score > 0 else None,
+                )
+
+                for pos, value in zip(positions, values):
+                    if cells[pos].value != value:
+                        cells[pos].value = value
+
+            if row - 1 != len(students):
+                raise Exception(
+                    f"Only wrote {row - 1} of {len(students)} students to the tutorial sheet"
                 )
 
+            # Clear the rows left after the last student (e.g. blank rows skipped when loading)
+            for cells in rows:
+                for pos in positions:
+                    if cells[pos].value is not None:
+                        cells[pos].value = None
+
             workbook.save(filename=self.output_path)
-            workbook.close()
 
             return row - 1
 
@@ -266,10 +395,34 @@ class TakeAttendance:
     def run(self):
         student_attendance = self._load_student_attendance()
         print(f"Loaded {len(student_attendance)} students from {self.input_path}")
-        attendance_dict = self._load_tutorial_list()
-        print(f"Found {len(attendance_dict)} students from {self.output_path}")
-        new_attendance = self._update_attendance(student_attendance, attendance_dict)
-        num = self._write_tutorial_list(new_attendance)
+
+        # Parse the workbook once and share it between the read and write passes.
+        # The writable workbook always keeps its formulas, cached values are read from a separate read-only copy.
+        workbook = self._open_tutorial_workbook()
+        values_workbook = workbook
+
+        try:
+            if self.data_only:
+                values_workbook = self._open_tutorial_workbook(data_only=True)
+
+            try:
+                attendance_dict = self._load_tutorial_list(values_workbook)
+            except FormulaFoundError as e:
+                print(f"{e}, reading cached values instead...")
+                self.data_only = True
+                values_workbook = self._open_tutorial_workbook(data_only=True)
+                attendance_dict = self._load_tutorial_list(values_workbook)
+
+            print(f"Found {len(attendance_dict)} students from {self.output_path}")
+            new_attendance = self._update_attendance(
+                student_attendance, attendance_dict
+            )
+            num = self._write_tutorial_list(workbook, new_attendance)
+        finally:
+            if values_workbook is not workbook:
+                values_workbook.close()
+            workbook.close()
+
         print(f"Successfully wrote {num} students to {self.output_path}!")
 
 